@@ -13,6 +13,8 @@ CLIENT_ADR = ('', CLIENT_PORT)
 class ClientConnection(Connection):
     """ A `Connection` that holds a socket
     """
+    __slots__ = ('sock',)
+
     def __init__(self, remote_adr, remote_seq_num, seq_num, sock):
         super().__init__(remote_adr, remote_seq_num, seq_num)
         self.sock = sock
@@ -152,19 +154,16 @@ def process_app_message(msg, connection, current_content):
     if msg.seq_no == connection.next_expected_index():
         return process_next_app_message(msg, connection, current_content)
 
-    elif msg.seq_no == connection.last_index_received:
-        # Client ACK was lost. We have already processed this message.
-        logging.debug("Re-ACKing seq {}".format(msg.seq_no))
-        send_ack(msg, connection, connection.sock)
-        return current_content
-
     else:
-        # Unknown seq no
-        s = "Bad sequence number {} during file transfer. Expected {}." \
-            .format(msg.seq_no,
-                    connection.next_expected_index())
-        logging.error(s)
-        return None
+        # Either a client ACK was lost and we have already processed this
+        # message, or an earlier message was lost and the server has pipelined
+        # past it. Discard it and re-ACK the last message processed in order.
+        logging.debug("Discarding seq {}. Re-ACKing seq {}"
+                      .format(msg.seq_no, connection.last_index_received))
+        ack = create_ack_message(connection.seq_num,
+                                 connection.last_index_received)
+        send_message(connection.sock, ack, connection.remote_adr)
+        return current_content
 
 
 def process_next_app_message(msg, connection, current_content):
@@ -3,9 +3,20 @@
     Server over UDP Protocol) as defined in the assignment 3 specification and
     the associated README.
 """
+import errno
 import logging
 import socket
+import struct
+import sys
 import time
+from enum import IntEnum
+from typing import Optional
+
+try:
+    from mypy_extensions import mypyc_attr
+except ImportError:  # Only needed when compiling with mypyc
+    def mypyc_attr(*attrs, **kwattrs):  # type: ignore[misc]
+        return lambda cls: cls
 
 # Packet Parameters
 MAX_PACKET_SIZE = 1024
@@ -13,10 +24,43 @@ HEADER_SIZE = 6
 MAX_PAYLOAD_SIZE = MAX_PACKET_SIZE - HEADER_SIZE
 MAX_SEQ_NUMBER = 255
 MAX_ACK_NUMBER = 255
+ACK_BIT_MASK = 0x80  # 1000 0000
+
+# Header layout: A bit and packet type, reserved byte, sequence number,
+# acknowledgement number, and payload length, in network byte order. Compiled
+# once rather than parsing the format on every message.
+_HEADER = struct.Struct('!BxBBH')
+
+# UDP generic segmentation offload (GSO), Linux 4.18+. One sendmsg call hands
+# the kernel a run of frames, which it splits back into datagrams of
+# MAX_PACKET_SIZE bytes. Older versions of the socket module do not name the
+# UDP_SEGMENT option.
+_UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+_GSO_ANCILLARY = [(socket.IPPROTO_UDP, _UDP_SEGMENT,
+                   struct.pack('=H', MAX_PACKET_SIZE))]
+# A run must fit in one maximum size UDP datagram, and the kernel accepts at
+# most 64 segments
+_GSO_MAX_SEGMENTS = min(64, 65507 // MAX_PACKET_SIZE)
+# Errors raised when the kernel or network device does not support GSO
+_GSO_UNSUPPORTED_ERRNOS = (errno.EINVAL, errno.ENOPROTOOPT, errno.EOPNOTSUPP,
+                           errno.EIO)
+# Cleared once GSO is found not to be supported
+_gso_enabled = sys.platform.startswith('linux')
+
+# Flow Control
+# Go-Back-N requires the window to be smaller than the sequence number space.
+DEFAULT_WINDOW_SIZE = 16
 
 # Timeouts
 DEFAULT_ACK_TIMEOUT_SECONDS = 0.5
 DEFAULT_RETRY_THRESHOLD = 5
+MIN_ACK_TIMEOUT_SECONDS = 0.05
+# Consecutive timeouts back off no further than this
+MAX_ACK_TIMEOUT_SECONDS = DEFAULT_ACK_TIMEOUT_SECONDS * 2
+# With this few messages in flight, a loss cannot be inferred from later ACKs,
+# so once the RTT has been sampled, the first timeout is capped at the smoothed
+# RTT (or MIN_ACK_TIMEOUT_SECONDS, if longer).
+TAIL_IN_FLIGHT_THRESHOLD = 2
 FIN_KEEP_ALIVE = DEFAULT_ACK_TIMEOUT_SECONDS * 2
 
 # HTTP-Related
@@ -24,25 +68,52 @@ HTTP_OK_ENCODED = b'200'
 HTTP_FILE_NOT_FOUND_ENCODED = b'404'
 HTTP_CODE_LEN = 3  # Bytes to encode 3 digit HTTP code
 
-# Ugly, but we need bidirectional mapping and this is unlikely to change.
-PACKET_TYPES_IDS = {
-    "ACK": 0,
-    "SYN": 1,
-    "FIN": 2,
-    "APP": 3,
-}
-PACKET_IDS_TYPES = ["ACK", "SYN", "FIN", "APP"]
 
+class PacketType(IntEnum):
+    """ Packet types, valued by their ID on the wire.
+    """
+    ACK = 0
+    SYN = 1
+    FIN = 2
+    APP = 3
+
+
+# Indexing a tuple is cheaper than calling PacketType(packet_type_id)
+PACKET_TYPES_BY_ID = tuple(PacketType)
 
+
+# Subclassed by the client's interpreted ClientConnection
+@mypyc_attr(allow_interpreted_subclasses=True)
 class Connection:
     """ Represents an RDP connection between the owner of an instance and some
     remote party.
     """
+    # Connection state is read on every packet. Slots make those reads cheaper
+    # than lookups in an instance dictionary.
+    __slots__ = ('remote_adr',
+                 'last_index_received',
+                 'seq_num',
+                 'srtt',
+                 'min_srtt',
+                 'max_srtt')
+
+    remote_adr: tuple
+    last_index_received: int
+    seq_num: int
+    srtt: Optional[float]
+    min_srtt: Optional[float]
+    max_srtt: Optional[float]
+
     def __init__(self, remote_adr, remote_seq_num, seq_num=0):
         self.remote_adr = remote_adr
         self.last_index_received = remote_seq_num % MAX_SEQ_NUMBER
         self.seq_num = seq_num % MAX_SEQ_NUMBER
 
+        # Smoothed round trip time, and its extremes, in seconds
+        self.srtt = None
+        self.min_srtt = None
+        self.max_srtt = None
+
     @staticmethod
     def _increment(n):
         return (n + 1) % MAX_SEQ_NUMBER
@@ -62,10 +133,50 @@ class Connection:
     def increment_next_expected_index(self):
         self.last_index_received = self.next_expected_index()
 
+    def update_rtt(self, rtt):
+        """ Folds a round trip time sample, in seconds, into the smoothed RTT.
+        """
+        if self.srtt is None:
+            self.srtt = self.min_srtt = self.max_srtt = rtt
+        else:
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.min_srtt = min(self.min_srtt, self.srtt)
+            self.max_srtt = max(self.max_srtt, self.srtt)
+
+    def get_ack_timeout(self, attempts=0):
+        """ The time to wait for an ACK to a message that has already timed
+        out `attempts` times.
+
+        Until the RTT has been sampled, the base timeout is
+        `DEFAULT_ACK_TIMEOUT_SECONDS`. Afterwards it is the smoothed RTT scaled
+        by a factor, which ranges from 1 to 2 as the smoothed RTT moves from
+        the lowest value seen to the highest. The base timeout doubles for
+        each previous timeout, up to `MAX_ACK_TIMEOUT_SECONDS`.
+
+        RTTs are not sampled from re-sent messages, so without the doubling a
+        lost window would be re-sent at the same rate until the connection
+        timed out.
+        """
+        if self.srtt is None:
+            base = DEFAULT_ACK_TIMEOUT_SECONDS
+        else:
+            spread = self.max_srtt - self.min_srtt
+            factor = 1 + (self.srtt - self.min_srtt) / (spread + 1e-9)
+            base = max(MIN_ACK_TIMEOUT_SECONDS, self.srtt * factor)
+
+        if not attempts:
+            return base
+        return min(base * 2 ** attempts, max(base, MAX_ACK_TIMEOUT_SECONDS))
+
 
 class Message:
     """ Represents an RDP message with header fields and a payload.
     """
+    packet_type: PacketType
+    seq_no: int
+    ack_no: Optional[int]
+    src_adr: Optional[tuple]
+    dest_adr: Optional[tuple]
 
     def __init__(self,
                  packet_type,
@@ -77,7 +188,7 @@ class Message:
         """ Not for external use. Use factory methods to ensure consistency.
         """
 
-        self.packet_type = packet_type  # String, key to types dict
+        self.packet_type = packet_type
         self.ack_no = ack_no
         self.seq_no = seq_no
         self.payload = payload
@@ -88,35 +199,35 @@ class Message:
         return message_to_bytes(self) == message_to_bytes(other)
 
     def is_syn(self):
-        return self.packet_type == "SYN"
+        return self.packet_type == PacketType.SYN
 
     def is_fin(self):
-        return self.packet_type == "FIN"
+        return self.packet_type == PacketType.FIN
 
     def is_app(self):
-        return self.packet_type == "APP"
+        return self.packet_type == PacketType.APP
 
     def is_ack(self):
         # Note that this may return true in addition to is_syn etc.
         return self.ack_no is not None
 
     def is_ack_only(self):
-        return self.packet_type == "ACK"
+        return self.packet_type == PacketType.ACK
 
     def get_payload_as_text(self):
-        return self.payload.decode()
+        return str(self.payload, 'utf-8')
 
 
 def create_syn_message(seq_no, ack_no=None):
     """ Utility to create an RDP SYN message
     """
-    return Message("SYN", seq_no, ack_no)
+    return Message(PacketType.SYN, seq_no, ack_no)
 
 
 def create_ack_message(seq_no, ack_no):
     """ Utility to create an RDP DATA message
     """
-    return Message("ACK", seq_no, ack_no)
+    return Message(PacketType.ACK, seq_no, ack_no)
 
 
 def create_app_message(seq_no, ack_no, data):
@@ -124,93 +235,106 @@ def create_app_message(seq_no, ack_no, data):
 
     :param seq_no The sequence number to use
     :param ack_no The sequence number to use
-    :param data The payload of the message, in binary form
+    :param data The payload of the message, in binary form. Any object
+    supporting the buffer protocol (e.g. a `memoryview`) is accepted.
     """
-    return Message("APP", seq_no, ack_no, data)
+    return Message(PacketType.APP, seq_no, ack_no, data)
 
 
 def create_fin_message(seq_no, ack_no):
     """ Utility to create an RDP FIN message
     """
-    return Message("FIN", seq_no, ack_no)
+    return Message(PacketType.FIN, seq_no, ack_no)
 
 
 def message_from_bytes(binary_message, src_adr=None, dest_adr=None):
-    """ Creates a message from the given bytearray representation.
-    """
-    # First byte holds ack bit and packet type
-    ack_bit_mask = 0x80  # 1000 0000
-    ack_bit = binary_message[0] & ack_bit_mask
-
-    packet_type_id = binary_message[0] & (~ack_bit_mask)
-    packet_type = PACKET_IDS_TYPES[packet_type_id]
-
-    # Second byte is reserved
+    """ Creates a message from the given binary representation.
 
-    # Third byte holds sequence number
-    seq_no = binary_message[2]
+    Any object supporting the buffer protocol is accepted. The payload is
+    copied, so the message remains valid if the buffer is reused.
+    """
+    (first_byte, seq_no, ack_no, payload_len) = \
+        _HEADER.unpack_from(binary_message)
 
-    # Fourth byte holds ACK number
-    ack_no = binary_message[3] if ack_bit else None
+    # First byte holds ack bit and packet type
+    packet_type = PACKET_TYPES_BY_ID[first_byte & ~ACK_BIT_MASK]
+    if not first_byte & ACK_BIT_MASK:
+        ack_no = None
 
     # Remaining bytes are the payload
-    payload_len = get_payload_len(binary_message[:HEADER_SIZE])
-    payload = binary_message[HEADER_SIZE: payload_len + HEADER_SIZE]
+    payload = bytes(binary_message[HEADER_SIZE: payload_len + HEADER_SIZE])
 
     return Message(packet_type, seq_no, ack_no, payload, src_adr, dest_adr)
 
 
-def get_payload_len(header_bytes):
-    # Fifth and sixth bytes hold payload length
-    msb = header_bytes[4]
-    lsb = header_bytes[5]
-    return (msb << 8) | lsb
-
-
 def message_to_bytes(msg):
     """ Converts the given message into its binary representation
     """
     payload_len = min(len(msg.payload), MAX_PAYLOAD_SIZE)
     binary_msg = bytearray(HEADER_SIZE + payload_len)
+    pack_message_into(binary_msg, msg)
+    return binary_msg
+
 
-    packet_type = PACKET_TYPES_IDS[msg.packet_type]
-    ack_bit_mask = 0x80
-    first_byte = packet_type | ack_bit_mask if msg.is_ack() else packet_type
-    binary_msg[0] = first_byte
+def pack_message_into(buf, msg):
+    """ Writes the binary representation of the message to the start of the
+    given buffer.
 
-    binary_msg[2] = msg.seq_no
+    Lets callers reuse a buffer of `MAX_PACKET_SIZE` bytes rather than
+    allocating one per message.
 
-    if msg.is_ack():
-        binary_msg[3] = msg.ack_no
+    :return: A `memoryview` of the part of the buffer written
+    """
+    payload_len = min(len(msg.payload), MAX_PAYLOAD_SIZE)
+    pack_header_into(buf,
+                     msg.packet_type,
+                     msg.seq_no,
+                     msg.ack_no,
+                     payload_len)
 
-    len_msb = (payload_len >> 8) & 0xFF
-    binary_msg[4] = len_msb
-    len_lsb = payload_len & 0xFF
-    binary_msg[5] = len_lsb
+    end = HEADER_SIZE + payload_len
+    view = memoryview(buf)
+    view[HEADER_SIZE:end] = memoryview(msg.payload)[:payload_len]
+    return view[:end]
 
-    binary_msg[6:] = msg.payload
 
-    return binary_msg
+def pack_header_into(buf, packet_type, seq_no, ack_no, payload_len):
+    """ Writes an RDP header to the start of the given buffer.
+
+    Lets callers that write the payload into the buffer themselves frame it in
+    place.
+
+    :param ack_no: `None` if the message is not an acknowledgement
+    """
+    if ack_no is None:
+        _HEADER.pack_into(buf, 0, packet_type, seq_no, 0, payload_len)
+    else:
+        _HEADER.pack_into(buf, 0, packet_type | ACK_BIT_MASK, seq_no, ack_no,
+                          payload_len)
 
 
 def is_ack_for_message(message, ack):
     return ack.is_ack() and message.seq_no == ack.ack_no
 
 
-def send_until_ack_in(message, sock, remote_adr):
+def send_until_ack_in(message, sock, remote_adr,
+                      timeout=DEFAULT_ACK_TIMEOUT_SECONDS):
     """ Transmits the message given and waits for an ACK.
 
     Sends the message in binary form to the given address via the given
     socket. The message will be re-sent after each timeout until either an
     ACK is received or the maximum number of timeouts is reached.
 
+    :param remote_adr: `None` if the socket is connected to the remote party
+    :param timeout: The time to wait for an ACK after each transmission
+
     :return: The ACK `Message` if received,  `None` otherwise
     """
 
     attempts = 0
     while attempts < DEFAULT_RETRY_THRESHOLD + 1:
         send_message(sock, message, remote_adr)
-        ack = await_ack(message, sock, remote_adr)
+        ack = await_ack(message, sock, remote_adr, timeout)
         attempts += 1
         if ack:
             logging.debug("ACK received after {} attempts".format(attempts))
@@ -231,6 +355,8 @@ def await_ack(msg_out, sock, remote_adr, timeout=DEFAULT_ACK_TIMEOUT_SECONDS):
     :param msg_out: The message to be ACK'd
     :param sock: The socket on which to listen.
     :param remote_adr: The address of the socket from which the ack must come.
+    `None` if the socket is connected, as the kernel then drops datagrams from
+    anyone else.
     :return: The ACK message if one is received. `None` otherwise.
     """
     logging.debug("Awaiting ACK")
@@ -258,7 +384,8 @@ def try_receive_ack(msg_out, timeout, sock, remote_adr):
     logging.debug("Attempting to receive ACK")
     try:
         msg_in = try_read_message(sock, timeout)
-        if msg_in.src_adr == remote_adr and is_ack_for_message(msg_out, msg_in):
+        if ((remote_adr is None or msg_in.src_adr == remote_adr)
+                and is_ack_for_message(msg_out, msg_in)):
             logging.debug("ACK received successfully")
             return msg_in
         else:
@@ -271,35 +398,131 @@ def try_receive_ack(msg_out, timeout, sock, remote_adr):
     return None
 
 
-def try_read_message(sock, timeout=None):
+def try_read_message(sock, timeout=None, buf=None):
     """ Tries to read a message from the socket.
 
+        Only the source address is recorded on the message. Looking up the
+        local address would cost an extra system call per message.
+
+        :param buf: Optionally, a writable buffer of `MAX_PACKET_SIZE` bytes
+        to receive into, rather than allocating one per message.
+
         :raises `socket.timeout` if a time_out is given and a message cannot be
         read before it
     """
     logging.debug("Attempting to read message")
 
-    sock.settimeout(timeout)
-    (message_bytes, src_adr) = sock.recvfrom(MAX_PACKET_SIZE)
-    dest_adr = sock.getsockname()
-    message = message_from_bytes(message_bytes, src_adr, dest_adr)
+    # Changing the timeout toggles the blocking mode of the underlying file
+    # descriptor with a system call, so only do so when needed.
+    if sock.gettimeout() != timeout:
+        sock.settimeout(timeout)
+    message = _receive_message(sock, buf)
 
     logging.debug("Message (seq {}) read from {}"
-                  .format(message.seq_no, src_adr))
+                  .format(message.seq_no, message.src_adr))
 
     return message
 
 
-def send_message(sock, message, dest_adr):
+def read_pending_messages(sock, buf=None):
+    """ Reads every message already queued on the socket without blocking.
+
+        Leaves the socket in non-blocking mode, so that repeated calls (e.g.
+        each time `select` reports the socket readable) do not toggle it.
+
+        :param buf: As for `try_read_message`
+        :return: A list of the messages read, in order of arrival
+    """
+    if sock.gettimeout() != 0:
+        sock.settimeout(0)
+
+    messages = []
+    while True:
+        try:
+            messages.append(_receive_message(sock, buf))
+        except BlockingIOError:
+            break
+
+    logging.debug("Read {} pending message(s)".format(len(messages)))
+
+    return messages
+
+
+def _receive_message(sock, buf):
+    """ Receives one datagram and parses it, into `buf` if one is given.
+    """
+    if buf is None or not hasattr(sock, 'recvmsg_into'):  # Windows
+        (message_bytes, src_adr) = sock.recvfrom(MAX_PACKET_SIZE)
+    else:
+        (nbytes, _, _, src_adr) = sock.recvmsg_into([buf])
+        message_bytes = memoryview(buf)[:nbytes]
+
+    return message_from_bytes(message_bytes, src_adr)
+
+
+def send_message(sock, message, dest_adr=None):
     """ Sends the message to the provided address and updates message metadata.
+
+    As with `try_read_message`, the local address is not recorded.
+
+    :param dest_adr: `None` to send to the address the socket is connected
+    to. Some platforms (e.g. macOS) reject an address on a connected socket.
     """
     logging.debug("Sending message (seq {}) to {}"
                   .format(message.seq_no, dest_adr))
 
     message.dest_adr = dest_adr
-    message.src_adr = sock.getsockname()
     binary_message = message_to_bytes(message)
-    sock.sendto(binary_message, dest_adr)
+    if dest_adr is None:
+        sock.send(binary_message)
+    else:
+        sock.sendto(binary_message, dest_adr)
+
+
+def send_frames(sock, frames):
+    """ Sends each of the given serialized messages as a datagram, in order,
+    over a connected socket.
+
+    Where UDP GSO is supported, each run of frames is sent with one sendmsg
+    call rather than one call per frame. The kernel splits a run into
+    datagrams of MAX_PACKET_SIZE bytes, so a frame shorter than that ends its
+    run. Otherwise, each frame is sent on its own.
+
+    If the socket is non-blocking and its send buffer fills, the remaining
+    frames are dropped, as they could be on the network. The caller must
+    re-send any frame that is not acknowledged.
+    """
+    global _gso_enabled
+
+    if _gso_enabled:
+        run = []
+        try:
+            for frame in frames:
+                run.append(frame)
+                if (len(frame) < MAX_PACKET_SIZE
+                        or len(run) == _GSO_MAX_SEGMENTS):
+                    sock.sendmsg(run, _GSO_ANCILLARY)
+                    run = []
+            if run:
+                sock.sendmsg(run, _GSO_ANCILLARY)
+            return
+        except BlockingIOError:
+            logging.debug("Send buffer full. Dropping frames.")
+            return
+        except OSError as e:
+            if e.errno not in _GSO_UNSUPPORTED_ERRNOS:
+                raise
+            logging.info("UDP GSO not supported ({}). Sending datagrams "
+                         "individually.".format(e.strerror))
+            _gso_enabled = False
+
+    # Any frames already sent by GSO are sent again. Duplicates are
+    # discarded by the receiver.
+    try:
+        for frame in frames:
+            sock.send(frame)
+    except BlockingIOError:
+        logging.debug("Send buffer full. Dropping frames.")
 
 
 def send_ack(msg_in, connection, sock):
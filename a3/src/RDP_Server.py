@@ -1,4 +1,7 @@
+import collections
+import math
 import os
+import selectors
 import sys
 from socket import *
 
@@ -7,6 +10,13 @@ from .RDP_Protocol import *
 logging.basicConfig(level=logging.INFO)
 
 CONNECTION_TIMEOUT = DEFAULT_RETRY_THRESHOLD * DEFAULT_ACK_TIMEOUT_SECONDS
+CHUNK_SIZE = MAX_PAYLOAD_SIZE - HTTP_CODE_LEN  # Bytes of file per APP message
+
+# Indices into the dispatch table (see Server._classify)
+DISPATCH_SYN = 0
+DISPATCH_NO_CONNECTION = 1
+DISPATCH_BAD_SEQUENCE = 2
+DISPATCH_BY_TYPE = 3  # Plus the packet type of an in-sequence message
 
 
 class Server:
@@ -14,8 +24,29 @@ class Server:
     def __init__(self, adr):
         self.adr = adr
         self.sock = None  # Socket is bound once serve is called
+        self.selector = None  # Watches the socket once it is bound
         self.conn = None
 
+        # Set by `stop`. The pair of sockets wakes the selector when it is.
+        self._stopping = False
+        self._wakeup = None
+
+        # Every datagram is received into this one buffer
+        self.rx_buf = bytearray(MAX_PACKET_SIZE)
+
+        # Handlers for in-sequence messages on an established connection, by
+        # packet type
+        handlers = {PacketType.APP: self._process_get_request}
+
+        # Every inbound message is passed to one handler in this table, at the
+        # index given by `_classify`
+        self._dispatch_table = (
+            (self._handle_syn,
+             self._drop_without_connection,
+             self._handle_bad_sequence)
+            + tuple(handlers.get(packet_type, self._drop_message)
+                    for packet_type in PacketType))
+
     def serve(self):
         """ Serve on the configured port.
         """
@@ -27,14 +58,47 @@ class Server:
             # user interrupt) after closing the socket
             raise
         finally:
+            self.close()
+
+    def stop(self):
+        """ Makes `serve` return, from another thread.
+
+        A transfer in progress is dropped. A handshake or close in progress is
+        allowed to finish first.
+        """
+        self._stopping = True
+        if self._wakeup:
+            self._wakeup[1].send(b"\0")
+
+    def close(self):
+        """ Closes the server's sockets and selector. `serve` closes them
+        before returning.
+        """
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if self.sock:
             self.sock.close()
             self.sock = None
+        if self._wakeup:
+            for sock in self._wakeup:
+                sock.close()
+            self._wakeup = None
 
     def _create_and_bind_socket(self):
         sock = socket.socket(AF_INET, SOCK_DGRAM)
         sock.bind(self.adr)
+        sock.setblocking(False)
         self.sock = sock
 
+        # Registered once per socket, rather than polling through a socket
+        # timeout on every read.
+        if not self.selector:
+            self.selector = selectors.DefaultSelector()
+            self._wakeup = socket.socketpair()
+            self.selector.register(self._wakeup[0], selectors.EVENT_READ)
+        self.selector.register(sock, selectors.EVENT_READ)
+
         # Allow clients to query the new address. Useful when the address given
         # at construction is a wildcard.
         self.adr = self.sock.getsockname()
@@ -42,55 +106,108 @@ class Server:
         logging.debug("Created and bound socket to port {}".format(self.adr[1]))
 
     def _serve_loop(self):
-        while True:
-            try:
-                if not self.conn:
-                    logging.info("Serving on {}. Waiting for connection."
-                                 .format(self.adr))
-
-                block = CONNECTION_TIMEOUT if self.conn else None
-                message = try_read_message(self.sock, block)
-                self._dispatch(message)
-            except socket.timeout:
+        while not self._stopping:
+            if not self.conn:
+                logging.info("Serving on {}. Waiting for connection."
+                             .format(self.adr))
+
+            block = CONNECTION_TIMEOUT if self.conn else None
+            if not self.selector.select(block):
                 self._abandon_connection("Connection timeout expired")
+                continue
+
+            # Handle every datagram queued since the last wake-up. Each one is
+            # only read once the last is handled, as handling a message may
+            # connect or replace the socket.
+            try:
+                while True:
+                    try:
+                        message = try_read_message(self.sock, 0, self.rx_buf)
+                    except BlockingIOError:
+                        break  # Nothing left to read
+                    self._dispatch(message)
+            except ConnectionRefusedError:
+                # Connected UDP sockets report ICMP port unreachable errors, on
+                # reads and sends alike
+                self._abandon_connection("Client port unreachable")
 
     def _abandon_connection(self, cause):
         logging.warning("Client connectivity lost ({}). Abandoning connection"
                         .format(cause))
         self.conn = None
+        self._disconnect_socket()
+
+    def _connect_socket(self, remote_adr):
+        """ Connects the socket to the client, so that the kernel drops
+        datagrams from anyone else and replies need no address.
+        """
+        self.sock.connect(remote_adr)
+
+        # Datagrams queued before connecting may be from anyone. A client only
+        # sends after receiving a reply, so none of them are needed.
+        read_pending_messages(self.sock)
+
+    def _disconnect_socket(self):
+        """ Replaces the socket with an unconnected one bound to the same
+        address, so that any client may connect.
+
+        A UDP socket is disconnected by connecting it to an AF_UNSPEC address,
+        which Python does not accept for AF_INET sockets.
+        """
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        self._create_and_bind_socket()
 
     def _dispatch(self, message):
         """ Dispatch an inbound message to the appropriate handler.
         """
         logging.debug("Dispatching message")
+        self._dispatch_table[self._classify(message)](message)
 
-        if self.conn and self.conn.remote_adr != message.src_adr:
-            logging.warning("Existing connection with {}. "
-                            "Dropping packet received from {}"
-                            .format(self.conn.adr, message.src_adr))
+    def _classify(self, message):
+        """ The index of the handler for the given message in the dispatch
+        table.
 
-        elif message.is_syn():
-            ack = self._receive_connection(message)
-            if ack and not ack.is_ack_only():
-                # We do not need to wait for the ACK_ONLY message if it is lost
-                # before processing the following GET message as it will also
-                # ACK the initial SYN message with the same sequence number.
-                self._dispatch(ack)
+        There is no need to check the sender. While there is a connection the
+        socket is connected to the client, and the kernel drops anything else.
+        """
+        if message.packet_type == PacketType.SYN:
+            return DISPATCH_SYN
 
-        elif not self.conn:
-            logging.warning("Received non-SYN message without a connection. "
-                            "Dropping.")
+        conn = self.conn
+        if not conn:
+            return DISPATCH_NO_CONNECTION
 
-        elif message.seq_no != self.conn.next_expected_index():
-            error_message = "Bad sequence number: {}. Expected {}"\
-                .format(message.seq_no, self.conn.last_index_received + 1)
-            self._abandon_connection(error_message)
+        # Inlined Connection.next_expected_index
+        if message.seq_no != (conn.last_index_received + 1) % MAX_ACK_NUMBER:
+            return DISPATCH_BAD_SEQUENCE
 
-        elif message.packet_type == "APP":
-            self._process_get_request(message)
+        return DISPATCH_BY_TYPE + message.packet_type
 
-        else:
-            logging.warning("Failed to dispatch message. Dropping packet.")
+    def _handle_syn(self, message):
+        ack = self._receive_connection(message)
+        if ack and not ack.is_ack_only():
+            # We do not need to wait for the ACK_ONLY message if it is lost
+            # before processing the following GET message as it will also
+            # ACK the initial SYN message with the same sequence number.
+            # Dispatch it like any other message, so that its sequence number
+            # is checked.
+            self._dispatch(ack)
+
+    @staticmethod
+    def _drop_without_connection(message):
+        logging.warning("Received non-SYN message without a connection. "
+                        "Dropping.")
+
+    def _handle_bad_sequence(self, message):
+        error_message = "Bad sequence number: {}. Expected {}"\
+            .format(message.seq_no, self.conn.next_expected_index())
+        self._abandon_connection(error_message)
+
+    @staticmethod
+    def _drop_message(message):
+        logging.warning("Failed to dispatch {} message. Dropping packet."
+                        .format(message.packet_type.name))
 
     def _receive_connection(self, syn):
         """ Processes a SYN message and creates a connection.
@@ -107,6 +224,7 @@ class Server:
             logging.warning("Received SYN message from already connected client")
         else:
             logging.info("Connection request (SYN) from {}".format(syn.src_adr))
+            self._connect_socket(syn.src_adr)
 
         self.conn = Connection(syn.src_adr, syn.seq_no)
 
@@ -132,54 +250,174 @@ class Server:
 
         if not os.path.isfile(filename):
             logging.info("No such file '{}'".format(filename))
-            ack = self._send_data(HTTP_FILE_NOT_FOUND_ENCODED)
-            if not ack:
-                return
+            sent = self._send_window(HTTP_FILE_NOT_FOUND_ENCODED, lambda _: 0)
         else:
-            chunk_size = MAX_PAYLOAD_SIZE - HTTP_CODE_LEN
-            chunks = self._get_data_from_file(filename, chunk_size)
-
-            logging.info("Sending data in {} chunk(s)".format(len(chunks)))
-            for chunk in chunks:
-                ack = self._send_data(HTTP_OK_ENCODED + chunk)
-                if not ack:
-                    return
-
-        self._close_connection()
-
-    def _send_data(self, data):
-        """ Sends the given application data to the client.
-
-        Wraps the given data in an APP message and sends it to the client. Waits
-        until an ACK is received before returning.
-
-        :param data The binary data to be sent
-
-        :return `None` if the connection was lost. The ack message to the data
-        message sent otherwise.
+            num_chunks = max(math.ceil(os.path.getsize(filename) / CHUNK_SIZE),
+                             1)
+            logging.info("Sending data in {} chunk(s)".format(num_chunks))
+
+            # Unbuffered, so that each chunk is read straight into the packet
+            # buffer it is sent from.
+            with open(filename, 'rb', buffering=0) as file:
+                sent = self._send_window(HTTP_OK_ENCODED, file.readinto)
+
+        if sent:
+            self._close_connection()
+
+    def _send_window(self, prefix, read_body, window=DEFAULT_WINDOW_SIZE):
+        """ Sends application data to the client using Go-Back-N.
+
+        Each APP message is framed in place in one of a ring of packet
+        buffers, one per slot in the window. `prefix` is written into every
+        buffer once, and `read_body` writes the rest of each payload directly
+        behind it, so the data is not copied again before it is sent. A slot
+        is only reused once its message has been ACK'd, so re-sending a
+        message needs no further reads. Frames are sent in batches (see
+        `send_frames`).
+
+        The frames are copied into the kernel on send. MSG_ZEROCOPY is not
+        used, as once the first window is sent, ACKs mostly slide it by one
+        message at a time, so most batches are a single frame. Only the first
+        window and re-sent windows are larger, at up to `window` frames.
+        Zerocopy pays for itself only on writes of roughly 10 KB or more, and
+        its completions arrive on the socket's error queue, which would wake
+        the selector until read with a further system call. sendfile cannot
+        add the header each datagram needs without extra system calls per
+        message.
+
+        Up to `window` messages are kept in flight at once. ACKs are
+        cumulative, so an ACK for any message in flight slides the window past
+        it. Every ACK queued on the socket is read each time it becomes
+        readable, and the window slides once per batch. If no ACK arrives
+        before the timeout, every message in flight is re-sent.
+
+        The timeout adapts to the round trip times sampled from ACKs (see
+        `Connection.get_ack_timeout`). The connection is abandoned if the
+        window does not slide for `CONNECTION_TIMEOUT` seconds.
+
+        :param prefix The bytes each payload begins with
+        :param read_body A function that writes the remainder of the next
+        payload into the given writable buffer, and returns the number of
+        bytes written (e.g. `readinto` of a file). At least one message is
+        sent. Later messages are sent until it returns 0.
+        :param window The maximum number of unacknowledged messages
+
+        :return `True` once every message has been ACK'd. `False` if the
+        connection was lost or the server was stopped.
         """
+        # ACKs could not be attributed to one message in the window otherwise
+        assert window < MAX_SEQ_NUMBER, \
+            "Programming error. Window must be smaller than sequence space."
+
+        # Bound locally, as they are used for every message in the loop below
+        sock = self.sock
+        conn = self.conn
+        selector = self.selector
+        rx_buf = self.rx_buf
+        now = time.time
+
+        ack_no = conn.last_index_received
+        prefix_len = len(prefix)
+        body_start = HEADER_SIZE + prefix_len
+
+        slots = []
+        for _ in range(window):
+            slot = memoryview(bytearray(MAX_PACKET_SIZE))
+            slot[HEADER_SIZE:body_start] = prefix
+            slots.append(slot)
+        bodies = [slot[body_start:] for slot in slots]
+
+        # Messages in flight, oldest first, as [seq_no, frame, send_time]. The
+        # send time is cleared when a message is re-sent, as its ACK could no
+        # longer be attributed to one transmission or the other.
+        in_flight = collections.deque()
+        sent = 0
+        exhausted = False
+        attempts = 0
+        last_progress = now()
+        stop_time = None
 
-        assert len(data) <= MAX_PAYLOAD_SIZE, "Data chunk too large"
-
-        ack_no = self.conn.last_index_received
-        seq_no = self.conn.get_seq_and_increment()
-
-        msg = create_app_message(seq_no, ack_no, data)
-        return self._send_until_ack_in(msg)
-
-    @staticmethod
-    def _get_data_from_file(filename, chunk_size=MAX_PAYLOAD_SIZE):
-        chunks = []
-        with open(filename, 'rb') as file:
-            chunk = file.read(chunk_size)
-            while chunk:
-                chunks.append(chunk)
-                chunk = file.read(chunk_size)
-
-        if not chunks:
-            chunks = [bytes(0)]
-
-        return chunks
+        while True:
+            # New frames are sent together once the window is filled
+            new_frames = []
+            while not exhausted and len(in_flight) < window:
+                i = sent % window
+                n = read_body(bodies[i])
+                if not n:
+                    exhausted = True
+                    if sent:
+                        break
+
+                seq_no = conn.get_seq_and_increment()
+                payload_len = prefix_len + n
+                pack_header_into(slots[i], PacketType.APP, seq_no, ack_no,
+                                 payload_len)
+                frame = slots[i][:HEADER_SIZE + payload_len]
+                sent += 1
+                new_frames.append(frame)
+                in_flight.append([seq_no, frame, now()])
+            if new_frames:
+                send_frames(sock, new_frames)
+
+            if not in_flight:
+                return True
+
+            if stop_time is None:
+                stop_time = now() + self._get_window_timeout(
+                    len(in_flight), attempts)
+
+            time_remaining = max(stop_time - now(), 0)
+            events = selector.select(time_remaining)
+            if self._stopping:
+                return False
+            if not events:
+                if now() - last_progress > CONNECTION_TIMEOUT:
+                    self._abandon_connection("Connection timeout expired")
+                    return False
+
+                attempts += 1
+                logging.debug("No ACK received. Re-sending {} message(s)"
+                              .format(len(in_flight)))
+                for entry in in_flight:
+                    entry[2] = None
+                send_frames(sock, [entry[1] for entry in in_flight])
+                stop_time = now() + self._get_window_timeout(
+                    len(in_flight), attempts)
+                continue
+
+            acked = 0  # Number of messages in flight ACK'd by this batch
+            base_seq_no = in_flight[0][0]
+            for msg_in in read_pending_messages(sock, rx_buf):
+                if not msg_in.is_ack():
+                    logging.debug("Received message, but not valid ACK.")
+                    continue
+
+                # Position of the ACK'd message in the window, if it is in it
+                offset = (msg_in.ack_no - base_seq_no) % MAX_SEQ_NUMBER
+                if offset < len(in_flight):
+                    acked = max(acked, offset + 1)
+
+            if acked:
+                for _ in range(acked - 1):
+                    in_flight.popleft()
+                sent_at = in_flight.popleft()[2]
+                if sent_at is not None:
+                    conn.update_rtt(now() - sent_at)
+                attempts = 0
+                last_progress = now()
+                stop_time = None
+
+    def _get_window_timeout(self, in_flight, attempts):
+        """ The time to wait for the window to slide before re-sending it.
+        """
+        conn = self.conn
+        timeout = conn.get_ack_timeout(attempts)
+        if (in_flight < TAIL_IN_FLIGHT_THRESHOLD and not attempts
+                and conn.srtt is not None):
+            # Tail of the transfer. Probe early rather than wait a full RTO,
+            # but not before an ACK could have arrived.
+            timeout = min(timeout, max(MIN_ACK_TIMEOUT_SECONDS, conn.srtt))
+        return timeout
 
     def _close_connection(self):
         if not self.conn:
@@ -194,19 +432,27 @@ class Server:
 
         fin_ack_msg = self._send_until_ack_in(fin_msg)
         if not fin_ack_msg:
+            # The connection has already been abandoned
             logging.warning("No ACK received in response to FIN message.")
+            return
         elif not fin_ack_msg.is_fin():
             logging.warning("FIN message ACK was not itself a FIN message.")
         else:
             logging.info("Received FIN_ACK message. Disconnecting.")
         self.conn = None
+        self._disconnect_socket()
 
     def _send_until_ack_in(self, message):
         """ Transmits the message given and waits for an ACK. Abandons the
         connection if one is not received.
+
+        The socket is connected to the client, so no address is given.
         :return: The ACK `Message` if received,  `None` otherwise
         """
-        ack = send_until_ack_in(message, self.sock, self.conn.remote_adr)
+        ack = send_until_ack_in(message,
+                                self.sock,
+                                None,
+                                self.conn.get_ack_timeout())
         if not ack:
             self._abandon_connection("Maximum retries exceeded")
 
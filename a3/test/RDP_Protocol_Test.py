@@ -21,7 +21,7 @@ def _get_msg_pair():
     """ Create a matching message and binary representation
     """
 
-    packet_type = "SYN"
+    packet_type = PacketType.SYN
     seq_no = 100
     ack_no = 55
     payload_len = MAX_PAYLOAD_SIZE - 1
@@ -36,7 +36,7 @@ def _get_msg_pair():
     binary_message = bytearray(HEADER_SIZE + payload_len)
     # First bit is ack flag. Remainder of first byte is packet type id.
     ack_flag = 1 << 7
-    pt_id = PACKET_TYPES_IDS[packet_type]
+    pt_id = int(packet_type)
     binary_message[0] = ack_flag | pt_id
 
     # Second byte is reserved. Third and fourth are seq and ack numbers.
@@ -75,6 +75,18 @@ class ProtocolTest(unittest.TestCase):
         message, binary_message = _get_msg_pair()
         self.assertEqual(binary_message, message_to_bytes(message))
 
+    def test_pack_message_into(self):
+        message, binary_message = _get_msg_pair()
+        buf = bytearray(os.urandom(MAX_PACKET_SIZE))
+
+        result = pack_message_into(buf, message)
+        self.assertEqual(binary_message, result)
+        self.assertEqual(binary_message, buf[:len(binary_message)])
+
+        # Reusing the buffer for a smaller message
+        ack = create_ack_message(get_rand_seq_no(), get_rand_seq_no())
+        self.assertEqual(message_to_bytes(ack), pack_message_into(buf, ack))
+
     def test_bytes_to_message(self):
         message, binary_message = _get_msg_pair()
         self.assertEqual(message, message_from_bytes(binary_message))
@@ -126,6 +138,45 @@ class ProtocolTest(unittest.TestCase):
         self.assertEqual(message1, result1)
         self.assertEqual(message2, result2)
 
+        # Messages read into a reused buffer must not change when it is reused
+        buf = bytearray(MAX_PACKET_SIZE)
+        send_message(self.loopback_sock, message2, LOOPBACK_ADR)
+        send_message(self.loopback_sock, message1, LOOPBACK_ADR)
+
+        result2 = try_read_message(self.loopback_sock, TEST_TIMEOUT, buf)
+        result1 = try_read_message(self.loopback_sock, TEST_TIMEOUT, buf)
+
+        self.assertEqual(message1, result1)
+        self.assertEqual(message2, result2)
+
+    def test_read_pending_messages(self):
+        self.assertEqual([], read_pending_messages(self.loopback_sock))
+
+        messages = [create_ack_message(get_rand_seq_no(), get_rand_seq_no())
+                    for _ in range(5)]
+        for message in messages:
+            send_message(self.loopback_sock, message, LOOPBACK_ADR)
+
+        self.assertEqual(messages, read_pending_messages(self.loopback_sock))
+        self.assertEqual([], read_pending_messages(self.loopback_sock))
+
+    def test_send_frames(self):
+        # A short frame ends a run of full size frames
+        frames = [os.urandom(size) for size in [MAX_PACKET_SIZE,
+                                                MAX_PACKET_SIZE,
+                                                HEADER_SIZE,
+                                                MAX_PACKET_SIZE,
+                                                MAX_PACKET_SIZE // 2]]
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(LOOPBACK_ADR)
+            send_frames(sock, frames)
+
+        self.loopback_sock.settimeout(TEST_TIMEOUT)
+        for frame in frames:
+            (result, _) = self.loopback_sock.recvfrom(MAX_PACKET_SIZE)
+            self.assertEqual(frame, result)
+
     def test_try_receive_ack(self):
         connection = Connection(LOOPBACK_ADR,
                                 get_rand_seq_no(),
@@ -157,6 +208,31 @@ class ProtocolTest(unittest.TestCase):
                                  LOOPBACK_ADR)
         self.assertIsNone(result)
 
+    def test_send_until_ack_in_connected(self):
+        msg_out = create_app_message(get_rand_seq_no(),
+                                     get_rand_seq_no(),
+                                     b"hello")
+        ack = create_ack_message(get_rand_seq_no(), msg_out.seq_no)
+
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((LOOPBACK_IP, 0))
+            sock.connect(LOOPBACK_ADR)
+
+            # Reply to the message once it arrives
+            def reply():
+                self.loopback_sock.settimeout(TEST_TIMEOUT)
+                (_, adr) = self.loopback_sock.recvfrom(MAX_PACKET_SIZE)
+                send_message(self.loopback_sock, ack, adr)
+            worker = threading.Thread(target=reply)
+            worker.start()
+
+            # No address is given on a connected socket
+            result = send_until_ack_in(msg_out, sock, None, TEST_TIMEOUT)
+            worker.join(TEST_TIMEOUT)
+
+        self.assertEqual(ack, result)
+        self.assertIsNone(msg_out.dest_adr)
+
     def test_await_ack(self):
         msg_out = create_syn_message(get_rand_seq_no(), get_rand_seq_no())
 
@@ -250,6 +326,44 @@ class ConnectionTest(unittest.TestCase):
 
             self.assertEqual(expected, result)
 
+    def test_get_ack_timeout(self):
+        # No RTT samples yet
+        self.assertEqual(DEFAULT_ACK_TIMEOUT_SECONDS,
+                         self.conn.get_ack_timeout())
+
+        # Never shorter than the minimum
+        self.conn.update_rtt(MIN_ACK_TIMEOUT_SECONDS / 10)
+        self.assertEqual(MIN_ACK_TIMEOUT_SECONDS, self.conn.get_ack_timeout())
+
+        # Factor is 1 at the lowest smoothed RTT seen ...
+        self.conn = Connection(LOOPBACK_ADR, 0, 0)
+        self.conn.update_rtt(0.2)
+        self.conn.update_rtt(0.05)
+        self.assertEqual(self.conn.min_srtt, self.conn.srtt)
+        srtt = self.conn.srtt
+        self.assertAlmostEqual(srtt, self.conn.get_ack_timeout())
+
+        # ... and consecutive timeouts double it, up to the maximum
+        self.assertAlmostEqual(2 * srtt, self.conn.get_ack_timeout(1))
+        self.assertAlmostEqual(4 * srtt, self.conn.get_ack_timeout(2))
+        self.assertEqual(MAX_ACK_TIMEOUT_SECONDS, self.conn.get_ack_timeout(3))
+
+        # The factor is 2 at the highest smoothed RTT seen
+        self.conn.update_rtt(2.0)
+        self.assertEqual(self.conn.max_srtt, self.conn.srtt)
+        self.assertAlmostEqual(2 * self.conn.srtt,
+                               self.conn.get_ack_timeout(), places=6)
+
+        # A base timeout above the maximum does not back off
+        self.conn = Connection(LOOPBACK_ADR, 0, 0)
+        self.conn.update_rtt(MAX_ACK_TIMEOUT_SECONDS * 2)
+        self.assertEqual(MAX_ACK_TIMEOUT_SECONDS * 2,
+                         self.conn.get_ack_timeout(1))
+
+        # Timeouts back off before the RTT is sampled too
+        self.conn = Connection(LOOPBACK_ADR, 0, 0)
+        self.assertEqual(MAX_ACK_TIMEOUT_SECONDS, self.conn.get_ack_timeout(1))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,15 @@
+import io
+import math
 import os
+import threading
 import unittest
 from socket import *
 
+from a3.src import RDP_Client
 from a3.src.RDP_Protocol import *
-from a3.src.RDP_Server import Server
+from a3.src.RDP_Server import (CHUNK_SIZE, DISPATCH_BAD_SEQUENCE,
+                                DISPATCH_BY_TYPE, DISPATCH_NO_CONNECTION,
+                                DISPATCH_SYN, Server)
 
 LOOPBACK = "127.0.0.1"
 SOCKET_ADDRESS = (LOOPBACK, 0)
@@ -16,33 +22,279 @@ class ServerTest(unittest.TestCase):
         self.server = Server(SOCKET_ADDRESS)
 
     def tearDown(self) -> None:
+        self.server.close()
+
+    def _start_serving(self, server):
+        """ Runs the server's event loop in a thread, returning once its
+        socket is bound. The server is stopped and closed after the test.
+        """
+        worker = threading.Thread(target=server.serve)
+        worker.start()
+        self.addCleanup(server.close)
+        self.addCleanup(worker.join, TIMEOUT)
+        self.addCleanup(server.stop)
+
+        stop_time = time.time() + TIMEOUT
+        while server.adr[1] == 0 and time.time() < stop_time:
+            time.sleep(0.01)
+        return worker
+
+    def _send_window_to_client(self, server, prefix, read_body, num_messages,
+                               window=DEFAULT_WINDOW_SIZE, drop_seq_no=None):
+        """ Runs `Server._send_window` on the given server against a client
+        thread that ACKs cumulatively.
+
+        :param drop_seq_no: A sequence number for which the client ignores the
+        first transmission, forcing the window to be re-sent.
+        :return: The result of `_send_window`, and the payloads received in
+        order
+        """
+        received = []
+
+        with socket.socket(AF_INET, SOCK_DGRAM) as client_sock:
+            client_sock.bind(SOCKET_ADDRESS)
+            client_sock.settimeout(TIMEOUT)
+
+            server._create_and_bind_socket()
+            server._connect_socket(client_sock.getsockname())
+            server.conn = Connection(client_sock.getsockname(), 0, 0)
+
+            def client():
+                dropped = False
+                last_in_order = None
+                while len(received) < num_messages:
+                    msg = try_read_message(client_sock, TIMEOUT)
+                    if msg.seq_no == drop_seq_no and not dropped:
+                        dropped = True
+                        continue
+                    if msg.seq_no == len(received):
+                        received.append(msg.payload)
+                        last_in_order = msg.seq_no
+                    if last_in_order is not None:
+                        ack = create_ack_message(0, last_in_order)
+                        send_message(client_sock, ack, server.adr)
+
+            worker = threading.Thread(target=client)
+            worker.start()
+            result = server._send_window(prefix, read_body, window)
+            worker.join(TIMEOUT)
+
+        return result, received
+
+    def test_classify(self):
+        syn = create_syn_message(10)
+        app = create_app_message(20, 0, b"file.txt")
+        self.assertEqual(DISPATCH_SYN, self.server._classify(syn))
+        self.assertEqual(DISPATCH_NO_CONNECTION, self.server._classify(app))
+
+        self.server.conn = Connection(SOCKET_ADDRESS, 20)
+        self.assertEqual(DISPATCH_SYN, self.server._classify(syn))
+        self.assertEqual(DISPATCH_BAD_SEQUENCE, self.server._classify(app))
+
+        app = create_app_message(21, 0, b"file.txt")
+        self.assertEqual(DISPATCH_BY_TYPE + PacketType.APP,
+                         self.server._classify(app))
+        self.assertEqual(self.server._process_get_request,
+                         self.server._dispatch_table[
+                             self.server._classify(app)])
+
+    def test_handle_syn_checks_reply_sequence(self):
+        self.server._create_and_bind_socket()
+        syn = create_syn_message(20)
+
+        # The reply to the SYN-ACK skips the expected sequence number
+        def receive_connection(message):
+            self.server.conn = Connection(SOCKET_ADDRESS, message.seq_no)
+            return create_app_message(22, 0, b"file.txt")
+        self.server._receive_connection = receive_connection
+
+        self.server._handle_syn(syn)
+        self.assertIsNone(self.server.conn)
+
+    def test_close_connection_without_fin_ack(self):
+        with socket.socket(AF_INET, SOCK_DGRAM) as client_sock:
+            client_sock.bind(SOCKET_ADDRESS)
+            self.server._create_and_bind_socket()
+            self.server._connect_socket(client_sock.getsockname())
+            self.server.conn = Connection(client_sock.getsockname(), 0)
+
+            # Disconnected once, when the FIN goes unanswered
+            disconnects = []
+            disconnect_socket = self.server._disconnect_socket
+
+            def count_disconnects():
+                disconnects.append(None)
+                disconnect_socket()
+            self.server._disconnect_socket = count_disconnects
+
+            self.server.conn.update_rtt(MIN_ACK_TIMEOUT_SECONDS / 10)
+            self.server._close_connection()
+
+        self.assertIsNone(self.server.conn)
+        self.assertEqual(1, len(disconnects))
+
+    def test_connect_socket(self):
+        with socket.socket(AF_INET, SOCK_DGRAM) as client_a, \
+                socket.socket(AF_INET, SOCK_DGRAM) as client_b:
+            client_a.bind(SOCKET_ADDRESS)
+            client_b.bind(SOCKET_ADDRESS)
+
+            self.server._create_and_bind_socket()
+
+            # Queued before connecting, so discarded
+            send_message(client_b, create_syn_message(1), self.server.adr)
+            self.server._connect_socket(client_a.getsockname())
+
+            # Only the connected client is heard
+            send_message(client_b, create_syn_message(2), self.server.adr)
+            send_message(client_a, create_syn_message(3), self.server.adr)
+            message = try_read_message(self.server.sock, TIMEOUT)
+            self.assertEqual(client_a.getsockname(), message.src_adr)
+            self.assertEqual(3, message.seq_no)
+
+            # Any client is heard once disconnected, on the same address
+            adr = self.server.adr
+            self.server._disconnect_socket()
+            self.assertEqual(adr, self.server.adr)
+            send_message(client_b, create_syn_message(4), self.server.adr)
+            message = try_read_message(self.server.sock, TIMEOUT)
+            self.assertEqual(client_b.getsockname(), message.src_adr)
+
+    def test_serve(self):
+        server = Server(SOCKET_ADDRESS)
+        worker = self._start_serving(server)
+
+        content = os.urandom(3 * MAX_PAYLOAD_SIZE)
+        filename = str(time.time()) + ".bin"
+        with open(filename, 'wb') as file:
+            file.write(content)
+
         try:
-            if self.server.sock:
-                self.server.sock.close()
-        except error:
-            pass
+            with socket.socket(AF_INET, SOCK_DGRAM) as client_a, \
+                    socket.socket(AF_INET, SOCK_DGRAM) as client_b:
+                client_a.bind(SOCKET_ADDRESS)
+                client_b.bind(SOCKET_ADDRESS)
+
+                connection = RDP_Client.connect_to_server(server.adr,
+                                                          client_a)
+                self.assertIsNotNone(connection)
 
-    def test_get_data_from_file(self):
-        inputs = ["hello".encode(),
+                # Another client's SYN is ignored while connected
+                syn = create_syn_message(10)
+                send_message(client_b, syn, server.adr)
+                self.assertRaises(timeout,
+                                  try_read_message,
+                                  client_b,
+                                  MIN_ACK_TIMEOUT_SECONDS * 4)
+
+                self.assertEqual(
+                    content,
+                    RDP_Client.get_from_server(filename, connection))
+
+                # And accepted once the connection is closed
+                send_message(client_b, syn, server.adr)
+                reply = try_read_message(client_b, TIMEOUT)
+                self.assertTrue(reply.is_syn())
+                self.assertTrue(is_ack_for_message(syn, reply))
+                ack = create_ack_message(syn.seq_no + 1, reply.seq_no)
+                send_message(client_b, ack, server.adr)
+
+                # The event loop ends once stopped
+                server.stop()
+                worker.join(TIMEOUT)
+                self.assertFalse(worker.is_alive())
+        finally:
+            os.remove(filename)
+
+    def test_send_file_window(self):
+        inputs = [b"",
+                  "hello".encode(),
                   "hello".encode() * 1000]  # 5000 bytes
 
         for input in inputs:
-            timestamp = str(time.time())
-            filename = timestamp + ".bin"
-            try:
-                file = open(filename, 'wb+', buffering=0)
-                file.write(input)
-                file.close()
-
-                result = Server._get_data_from_file(filename)
-
-                self.assertEqual(b"".join(result), input)
-
-                for chunk in result:
-                    self.assertLessEqual(len(chunk), MAX_PAYLOAD_SIZE)
-            finally:
-                if os.path.exists(filename):
-                    os.remove(filename)
+            with self.subTest(size=len(input)):
+                server = Server(SOCKET_ADDRESS)
+                filename = str(time.time()) + ".bin"
+                try:
+                    with open(filename, 'wb') as file:
+                        file.write(input)
+
+                    num_messages = max(math.ceil(len(input) / CHUNK_SIZE), 1)
+                    with open(filename, 'rb', buffering=0) as file:
+                        result, payloads = self._send_window_to_client(
+                            server, HTTP_OK_ENCODED, file.readinto,
+                            num_messages)
+
+                    self.assertTrue(result)
+                    for payload in payloads:
+                        self.assertLessEqual(len(payload), MAX_PAYLOAD_SIZE)
+                        self.assertEqual(HTTP_OK_ENCODED,
+                                         payload[:HTTP_CODE_LEN])
+                    self.assertEqual(
+                        input,
+                        b"".join(payload[HTTP_CODE_LEN:]
+                                 for payload in payloads))
+                finally:
+                    server.close()
+                    if os.path.exists(filename):
+                        os.remove(filename)
+
+    def test_send_window(self):
+        chunks = [bytes([i]) * MAX_PAYLOAD_SIZE for i in range(40)]
+        data = io.BytesIO(b"".join(chunks))
+
+        # Drop the first transmission of the 10th message
+        result, received = self._send_window_to_client(self.server,
+                                                       b"",
+                                                       data.readinto,
+                                                       len(chunks),
+                                                       window=8,
+                                                       drop_seq_no=10)
+
+        self.assertTrue(result)
+        self.assertEqual(chunks, received)
+
+
+    def test_send_window_slow_ack(self):
+        # A single message is not re-sent before an ACK could arrive, even
+        # if that takes longer than MIN_ACK_TIMEOUT_SECONDS
+        ack_delay = MIN_ACK_TIMEOUT_SECONDS * 2
+        received = []
+
+        with socket.socket(AF_INET, SOCK_DGRAM) as client_sock:
+            client_sock.bind(SOCKET_ADDRESS)
+            self.server._create_and_bind_socket()
+            self.server._connect_socket(client_sock.getsockname())
+            self.server.conn = Connection(client_sock.getsockname(), 0, 0)
+
+            def client():
+                received.append(try_read_message(client_sock, TIMEOUT))
+                time.sleep(ack_delay)
+                ack = create_ack_message(0, received[0].seq_no)
+                send_message(client_sock, ack, self.server.adr)
+                try:
+                    while True:
+                        received.append(
+                            try_read_message(client_sock, ack_delay * 2))
+                except timeout:
+                    pass
+
+            worker = threading.Thread(target=client)
+            worker.start()
+            result = self.server._send_window(HTTP_FILE_NOT_FOUND_ENCODED,
+                                              lambda _: 0)
+            worker.join(TIMEOUT)
+
+        self.assertTrue(result)
+        self.assertEqual(1, len(received))
+        self.assertEqual(HTTP_FILE_NOT_FOUND_ENCODED, received[0].payload)
+
+    def test_send_window_too_large(self):
+        self.assertRaises(AssertionError,
+                          self.server._send_window,
+                          b"",
+                          io.BytesIO().readinto,
+                          window=MAX_SEQ_NUMBER)
 
 
 if __name__ == '__main__':